@@ -2,16 +2,36 @@
 
 # pyvox module to export .vox file
 from pyvox.models import Vox as vx
+from pyvox.models import Color
 from pyvox.writer import VoxWriter as vw
 
-# deepcopy is used when subdividing by nested concatenation.
-from copy import deepcopy as dp
+# Used to write several .vox files in parallel.
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # pprint isn't called, but it's useful for debugging.
 from pprint import pprint
 
+import os
+import weakref
+
 import numpy as np
 
+# numba is optional. If present, the per-level expansion is JIT compiled
+# and runs in parallel across threads.
+try:
+	from numba import njit, prange
+except ImportError:
+	njit = None
+
+# cupy is optional. If present, MengerMagica(useGPU=True) builds on the GPU.
+try:
+	import cupy as cp
+except ImportError:
+	cp = None
+
 # ______________________________________________________
 # ______________________________________________________
 # This method is loosely based on
@@ -25,6 +45,125 @@ import numpy as np
 # ______________________________________________________
 # ______________________________________________________
 
+# Cubes written into a caller's buffer (e.g. a np.memmap) are filled in x-slabs
+# of about this many bytes, so no full dense copy is held in memory.
+_SLAB_BYTES = 1 << 24
+
+
+def _slabs(rows, rowBytes):
+	"""
+	Splits range(rows) into (start, stop) slabs of about _SLAB_BYTES each.
+	"""
+	step = max(1, _SLAB_BYTES // max(1, rowBytes))
+	for start in range(0, rows, step):
+		yield start, min(rows, start + step)
+
+
+def _expand(mask, keepBits, out = None):
+	"""
+	One level of subdivision: every voxel of mask becomes a 3x3x3 block.
+	keepBits is the 27-bit keep pattern, bit 9x+3y+z set for every (x,y,z)
+	that is retained. Empty voxels expand to an empty block.
+	The result is written into out if given, e.g. a np.memmap.
+	"""
+	keep = (keepBits >> np.arange(27)) & 1
+	keep = keep.astype(np.uint8).reshape(3, 3, 3)
+	if out is None:
+		return np.kron(mask, keep)
+
+	n = mask.shape[0]
+	for a, b in _slabs(n, 27 * n * n):
+		out[3 * a:3 * b] = np.kron(mask[a:b], keep)
+	return out
+
+
+if njit is not None:
+	@njit(cache=True, parallel=True)
+	def _expand(mask, keepBits, out = None):
+		# Branchless: every parent voxel splats keepBits (or 0) into its block,
+		# one row of 3 output voxels at a time.
+		# Each thread owns whole x planes of out, which it writes front to back.
+		n = mask.shape[0]
+		if out is None:
+			out = np.empty((3 * n, 3 * n, 3 * n), dtype=np.uint8)
+		for X in prange(3 * n):
+			x = np.int64(X) // 3
+			i = np.int64(X) - 3 * x
+			for Y in range(3 * n):
+				y, j = divmod(Y, 3)
+				for z in range(n):
+					w = (keepBits * (mask[x, y, z] != 0)) >> (9 * i + 3 * j)
+					out[X, Y, 3 * z] = w & 1
+					out[X, Y, 3 * z + 1] = (w >> 1) & 1
+					out[X, Y, 3 * z + 2] = (w >> 2) & 1
+		return out
+
+
+def _writeVox(filename, cube, palette = None):
+	"""
+	Writes cube to filename.vox, with palette if one is given. Lives at
+	module level so that worker processes can pickle it.
+	"""
+	vox = vx.from_dense(cube)
+	if palette:
+		vox.palette = palette
+	vw(filename, vox).write()
+
+
+# The cube and palette shared by every task of a slicedMany() worker.
+_workerCube = None
+_workerPalette = None
+
+
+def _initSliceWorker(cube, palette):
+	"""
+	Runs once per slicedMany() worker, so the cube is pickled once per
+	process instead of once per file.
+	"""
+	global _workerCube, _workerPalette
+	_workerCube = cube
+	_workerPalette = palette
+
+
+def _writeSliced(filename, depth):
+	"""
+	Slices the worker's cube to depth (see MengerMagica.sliced()) and writes
+	it to filename.vox.
+	"""
+	_writeVox(filename, _workerCube[depth:, depth:, depth:], _workerPalette)
+
+
+def _expandGPU(mask, keepBits, out = None):
+	"""
+	The cupy version of _expand(). Takes and returns arrays on the device,
+	unless out is given, which is filled on the host.
+	"""
+	keep = (keepBits >> cp.arange(27)) & 1
+	keep = keep.astype(cp.uint8).reshape(3, 3, 3)
+	if out is None:
+		return cp.kron(mask, keep)
+
+	n = mask.shape[0]
+	for a, b in _slabs(n, 27 * n * n):
+		out[3 * a:3 * b] = cp.kron(mask[a:b], keep).get()
+	return out
+
+
+def _host(a):
+	"""
+	Brings a cupy array back to the host. numpy arrays are returned as is.
+	"""
+	return a.get() if cp is not None and isinstance(a, cp.ndarray) else a
+
+
+def _pack(mask):
+	"""
+	Bit-packs mask along z wherever it lives and returns it on the host as a
+	plain ndarray, even when mask is a np.memmap.
+	"""
+	xp = cp if cp is not None and isinstance(mask, cp.ndarray) else np
+	return np.asarray(_host(xp.packbits(mask, axis=-1)))
+
 
 class MengerMagica:
 	"""
@@ -33,27 +172,47 @@ class MengerMagica:
 	Use the output or inverseOutput method to create files/start processing.
 	"""
 
-	def __init__(self, isColor = False):
+	def __init__(self, isColor = False, useGPU = False):
 		# ---------
 		# Boolean indicating whether to assign colors to each voxel
 		# If mono, each voxel is indicated by a 1 or 0.
 		# Note that the magicavoxel file format only recognizes a given
-		# voxels palette index. We use the included (slightly modified pyvox)
-		# to assign rgb to each voxel, which is then added to a palette/index.
+		# voxels palette index. Colour cubes store the palette index of their
+		# tint in each voxel, and the palette below is written with the file.
 		self.__monoroot = 1
 		self.__colorroot = [81, 168, 221]
 		self.__iscolor = isColor
 
+		# The distinct (r,g,b) of a colour cube. Entry k is the root colour
+		# tinted by 9 * k, and voxels with that tint hold palette index k + 1,
+		# since index 0 is empty. See __zIndex() for which voxels get which tint.
+		self.palette = []
+		for k in range(255):
+			self.palette.append(tuple((c + 9 * k) % 256 for c in self.__colorroot))
+
+		# Boolean indicating whether to build the sponge on the GPU with cupy.
+		# Results are always copied back to the host for pyvox.
+		if useGPU and cp is None:
+			raise ImportError("useGPU requires cupy to be installed")
+		self.__usegpu = useGPU
+
 		# The starting voxel. Needs to be 3D for pyvox
-		self.__base = [[[ self.__colorroot if isColor else self.__monoroot ]]]
-		# The (x,y,z) indices to be removed based on the lut base indices below
-		# pimaryLUT is populated after the first subdiv in generateLUT
-		self.__primaryLUT = []
-		# The following prevent recalculation. (haven't tested...)
+		# Only occupancy is tracked internally, rgb is added on output.
+		# uint8 from the start, every expansion keeps the dtype.
+		self.__base = np.array([[[ self.__monoroot ]]], dtype=np.uint8)
+		# The following prevent recalculation.
+		# Occupancy masks keyed by divisions, bit-packed along z (8 voxels/byte).
+		# Each level is built from the one below it, so all of them are kept.
+		self.__maskCache = {}
+		# The lut the cache was built with. Changing the lut clears the cache.
+		self.__cacheLUT = None
+		# The 27-bit keep pattern of that lut, see __keepBits().
+		self.__cacheKeepBits = None
+		# Used by sliced() when no cube is passed in.
 		self.__lastRunDivisions = None
-		self.__lastRunOutput = None
-		# Use this to visualize all deleted voxels. Returned by inverseOutput()
-		self.__outputInverse = None
+		# Memmaps handed out by output()/inverseOutput(), keyed by file path.
+		# A path is refused while its earlier array is still alive.
+		self.__mmaps = weakref.WeakValueDictionary()
 		# ---------
 
 		# The indices of a first level Menger cube which are to be removed
@@ -61,131 +220,148 @@ class MengerMagica:
 		self.lut = [4, 10, 12, 13, 14, 16, 22]
 
 	# ______________________________________________________
-	def __subdiv(self, element):
+	def __keepBits(self):
 		"""
-		This function takes an input multidimensional list.
-		It then duplicates the inputs component rows/cols/depths twice along
-		each axis to essentially triple the volume, resulting in a voxel cube.
-		This output cube is built of 27 input elements.
+		Builds the 27-bit keep pattern of a first level Menger cube from the lut.
+		Bit i is set for every voxel that is kept, i.e. not listed in the lut.
+
+		Changes in global lut > changes keep bits > changes the whole sponge.
 		"""
-		cube = tmp = dp(element)
+		bad = [i for i in self.lut if not 0 <= i <= 26]
+		if bad:
+			raise ValueError("lut entries must be in 0...26, got {}".format(bad))
 
-		colorizer = None
-		if self.__iscolor:
-			# Blanket adds a number depending on level to r,g,b
-			level = int(np.cbrt(tmp.shape[0]))
-			colorizer = np.vectorize(lambda t: 0 if t == 0 else t + (9 * level))
-		else:
-			# Uses the palette index for color assignment
-			# Disable this if you want an all-white (first palette index) cube
-			# colorizer = np.vectorize(lambda t: 0 if t == 0 else t + 1)
-			pass
+		# Filled once from the lut instead of testing membership per voxel.
+		keep = np.ones(27, dtype=np.int64)
+		keep[self.lut] = 0
+		return int((keep << np.arange(27)).sum())
+
+	# ______________________________________________________
+	def __menger(self, divisions, out = None):
+		"""
+		The primary method that builds the sponge from the lut.
+		It takes the depth to which to traverse and, unsurprisingly, returns a
+		menger cube as an nd numpy array of 1's and 0's.
+		Colour is only added on output, see __colorize().
+		If out is given (e.g. a np.memmap), the sponge is written into it.
+
+		A sponge of depth d is the Kronecker product of d keep patterns, so no
+		voxels have to be carved out after subdividing. Every level is cached,
+		and a deeper sponge continues from the deepest cached level below it.
+		"""
+		lut = tuple(self.lut)
+		if lut != self.__cacheLUT:
+			# Validates the lut before anything is cached for it.
+			self.__cacheKeepBits = self.__keepBits()
+			self.__maskCache = {}
+			self.__cacheLUT = lut
+
+		if divisions == 0:
+			if out is None:
+				return self.__base.copy()
+			out[...] = self.__base
+			return out
+
+		if divisions in self.__maskCache:
+			return self.__unpack(divisions, out)
+
+		start = max((k for k in self.__maskCache if k < divisions), default=0)
+		mask = self.__unpack(start) if start else self.__base
 
-		tmp = colorizer(tmp) if colorizer else tmp
+		xp = cp if self.__usegpu else np
+		expand = _expandGPU if self.__usegpu else _expand
+		mask = xp.asarray(mask)
 
-		for i in range(3):
-			for j in range(2):
-				cube = np.concatenate((cube,tmp), axis= 2 - i)
+		for i in range(start, divisions):
+			# Only the last level is written into out.
+			dst = out if i == divisions - 1 else None
+			mask = expand(mask, self.__cacheKeepBits, dst)
+			self.__maskCache[i + 1] = _pack(mask)
 
-			tmp=dp(cube)
-		return cube
+		return out if out is not None else _host(mask)
 
 	# ______________________________________________________
-	def __generateLUT(self, ndcube):
+	def __unpack(self, divisions, out = None):
 		"""
-		This function takes a n-dimensional numpy array of voxels.
-		If the input cube is of level 1 subdivision, i.e 3 voxels/side, then
-		we save the indices to the global primary var.
-		Otherwise, this function gets the relative level above 1 and uses the level
-		to create and return a list of (x,y,z) tuples whose voxels will be
-		removed.
-
-		Changes in global lut > changes primary > changes completeLUT.
+		Returns the cached occupancy mask for divisions as a dense array.
+		If out is given, it is filled slab by slab instead.
 		"""
-		completeLUT = []
-
-		# A constant that is one power less than the lenght of each side of cube
-		# It is used for generating indices of holes for the LUT.
-		# (Since holes are technically coming from one iteration down)
-		factor = int(ndcube.shape[0]/3)
-
-		if factor == 1:
-			ctr = 0
-			for idx, e in np.ndenumerate(ndcube):
-				if (ctr/3 if self.__iscolor else ctr) in self.lut:
-					if self.__iscolor:
-						(x, y, z, _) = idx
-						completeLUT.append((x,y,z))
-					else:
-						completeLUT.append(idx)
-				ctr += 1
-			self.__primaryLUT = completeLUT
-		else:
-			# This branch creates ranges of tuples from low to hi.
-			# i.e "Generate indices from (0,0,0) to (3,3,3) non inclusive."
-			lows = []
-			his = []
-			for t in self.__primaryLUT:
-				l = [factor * i for i in t]
-				l = tuple(l)
-				h = [factor * (i + 1) for i in t]
-				h = tuple(h)
-				lows.append(l)
-				his.append(h)
-
-			assert (len(lows) == len(his))
-			# Based on the above lows/his, fill in the intermediate voxel indices.
-			for l in range(len(lows)):
-				low = lows[l]
-				hi = his[l]
-				for x in range(low[0],hi[0]):
-					for y in range(low[1],hi[1]):
-						for z in range(low[2],hi[2]):
-							completeLUT.append((x,y,z))
-
-		return completeLUT
+		side = 3 ** divisions
+		packed = self.__maskCache[divisions]
+		if out is None:
+			return np.unpackbits(packed, axis=-1, count=side)
+
+		for a, b in _slabs(side, side * side):
+			out[a:b] = np.unpackbits(packed[a:b], axis=-1, count=side)
+		return out
 
 	# ______________________________________________________
-	def __carve(self, ndcube, table):
+	def __memmap(self, divisions, mmapFile):
 		"""
-		This function takes an input n-dimensional numpy array and a table of
-		indices which will be set to 0.
-		MUST be called ONLY after generateLUT() returns.
+		Returns a np.memmap of a cube of divisions backed by mmapFile, or None
+		if no file is given.
+		The file is overwritten, so a path whose earlier array is still in use
+		raises a ValueError instead of silently changing that array.
 		"""
-		# ONlY if this is >= level 1.
-		for idx, e in np.ndenumerate(ndcube):
-			if self.__iscolor:
-				(x, y, z, _) = idx
-				if (x,y,z) in table:
-					ndcube[x][y][z] = [0, 0, 0]
-			else:
-				(x, y, z) = idx
-				if idx in table:
-					ndcube[x][y][z] = 0
-
-		return ndcube
+		if not mmapFile:
+			return None
+
+		path = os.path.abspath(mmapFile)
+		if self.__mmaps.get(path) is not None:
+			raise ValueError(
+				"mmapFile {} still backs an array returned earlier. Use another "
+				"path or drop that array first".format(mmapFile))
+
+		side = 3 ** divisions
+		mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(side, side, side))
+		self.__mmaps[path] = mm
+		return mm
 
 	# ______________________________________________________
-	def __menger(self, start, divisions):
+	def __zIndex(self, divisions):
 		"""
-		The primary recursive method to repeatedly call the above methods.
-		It takes a starting 3D array as input and the depth to which to traverse.
-		Unsurprisingly, it returns a menger cube as an nd numpy array.
+		Returns the palette index of every z of a cube of divisions.
+		Each subdivision keeps the first third along z and tints the other two
+		thirds. Blanket adds a number depending on level to r,g,b, where the
+		level is the cube root of the side length before subdividing.
+		So a voxel's tint only depends on the base 3 digits of its z.
 		"""
+		z = np.arange(3 ** divisions)
+		ans = np.ones(z.shape, dtype=np.uint8)
+		for i in range(divisions):
+			tinted = (z // 3 ** i) % 3 != 0
+			ans += (tinted * int(np.cbrt(3.0 ** i))).astype(np.uint8)
+		return ans
 
-		# Ensure input is a numpy array
-		start = np.array(start)
+	# ______________________________________________________
+	def __colorize(self, mask, divisions):
+		"""
+		Turns an occupancy mask into palette indices.
+		Every retained voxel gets the palette index of its z, see __zIndex().
+		Empty voxels stay 0.
+		"""
+		zIndex = self.__zIndex(divisions)
 
-		# Base case
-		if divisions == 0:
-			return start
+		# In place, the mask is always a fresh array from __menger().
+		# Slab by slab, so a memmap is never shadowed by a full temporary.
+		for a, b in _slabs(mask.shape[0], mask[0].size):
+			slab = mask[a:b]
+			np.multiply(slab, zIndex[None, None, :], out=slab)
+		return mask
 
-		# Subdivide > based on the bigger cube decide zero indices > remove them
-		cube = self.__subdiv(start)
-		removals = set(self.__generateLUT(cube))
-		cube = self.__carve(cube,removals)
+	# ______________________________________________________
+	def __voxPalette(self):
+		"""
+		Returns the pyvox palette to write with colour cubes, or None for mono
+		cubes, which use the default palette.
+		"""
+		if not self.__iscolor:
+			return None
 
-		return self.__menger(cube, divisions - 1)
+		palette = [ Color(0, 0, 0, 0) ]
+		palette += [ Color(r, g, b, 255) for (r, g, b) in self.palette[:255] ]
+		palette += [ Color(0, 0, 0, 0) ] * (256 - len(palette))
+		return palette
 
 	# ______________________________________________________
 	def sliced(self, cube = None, depth = 1, filename = None):
@@ -193,63 +369,95 @@ class MengerMagica:
 		This method takes a menger cube and slices off a face along each axis till
 		the depth specified.
 		"""
-		output = dp(cube) if cube else dp(self.__lastRunOutput)
+		output = cube if cube is not None else self.output(self.__lastRunDivisions)
 
-		for i in range(depth):
-			for j in range(3): # Use this if you want to mirror all 3 axes
-				output = np.delete(output, 0, axis=j)
+		# Drop the first depth planes of all 3 axes with a single slice.
+		# Copied once so the result never aliases the input cube.
+		output = output[depth:, depth:, depth:].copy()
 
 		if filename:
-			vox = vx.from_dense(output)
-			vw(filename, vox).write()
+			_writeVox(filename, output, self.__voxPalette())
 
 		return output
 
 	# ______________________________________________________
-	def output(self, divisions, filename = None):
+	def slicedMany(self, depths, filenames, cube = None, processes = None):
+		"""
+		Slices the cube like sliced() for every depth and writes each result
+		to the matching filename. The pyvox export walks every voxel in python,
+		so the files are written in parallel worker processes.
+		The cube is sent once to each worker, which slices it there. Nothing is
+		returned, call sliced() for the arrays.
+
+		Workers are spawned, so they re-import the calling script. Call this
+		under an if __name__ == "__main__": guard. Without one the workers die,
+		and the files are written one by one in this process instead.
+		"""
+		depths = list(depths)
+		filenames = list(filenames)
+		if len(depths) != len(filenames):
+			raise ValueError(
+				"slicedMany needs one filename per depth, got {} depths and {} "
+				"filenames".format(len(depths), len(filenames)))
+
+		cube = cube if cube is not None else self.output(self.__lastRunDivisions)
+
+		# Spawn fresh workers. Forking after numba has started its thread pool
+		# leaves the interpreter hanging on exit.
+		context = multiprocessing.get_context("spawn")
+		palette = self.__voxPalette()
+		try:
+			with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+					initializer=_initSliceWorker,
+					initargs=(np.asarray(cube), palette)) as pool:
+				list(pool.map(_writeSliced, filenames, depths))
+		except BrokenProcessPool:
+			warnings.warn("slicedMany workers died, most likely because the "
+				"calling script has no if __name__ == \"__main__\": guard. "
+				"Writing the files one by one instead.")
+			for filename, depth in zip(filenames, depths):
+				_writeVox(filename, cube[depth:, depth:, depth:], palette)
+
+	# ______________________________________________________
+	def output(self, divisions, filename = None, mmapFile = None):
 		"""
 		Outputs a filename.vox file and returns the n-dimensional voxel array.
+		If mmapFile is given, the array is a np.memmap backed by that file,
+		so large cubes are paged out by the OS instead of held in memory.
+		The file is overwritten. Reusing the path of an array that is still
+		alive raises a ValueError.
 		"""
 
-		if not self.__lastRunOutput or self.__lastRunDivisions != divisions:
-			ans = self.__menger(self.__base, divisions)
-			ans = ans.astype('uint8')
+		ans = self.__menger(divisions, self.__memmap(divisions, mmapFile))
+		if self.__iscolor:
+			ans = self.__colorize(ans, divisions)
 
-			# TODO : Long-Diagonal slice
-			# diag = np.diag_indices(3, ndim=3)
-			# ans[diag] = 9
+		# TODO : Long-Diagonal slice
+		# diag = np.diag_indices(3, ndim=3)
+		# ans[diag] = 9
 
-			# Store if needed for re-rerun.
-			self.__lastRunDivisions = divisions
-			self.__lastRunOutput = dp(ans)
+		self.__lastRunDivisions = divisions
 
 		if filename:
-			vox = vx.from_dense(ans)
-			vw(filename, vox).write()
+			_writeVox(filename, ans, self.__voxPalette())
 
-		return self.__lastRunOutput
+		return ans
 
 	# ______________________________________________________
-	def inverseOutput(self, divisions, filename = None):
+	def inverseOutput(self, divisions, filename = None, mmapFile = None):
 		"""
-		Returns all voxels that were deleted by calling np.vectorize on
-		the array returned by output().
+		Returns all voxels that were deleted by inverting the array returned
+		by output(). mmapFile works as in output().
 		"""
 
-		if not self.__outputInverse:
-			ans = self.__menger(self.__base, divisions)
-
-			# Invert the 1's and 0's.
-			# NOTE: Does NOT work with color
-			self.__outputInverse = dp(ans)
-			inverter = np.vectorize(lambda t: 0 if t == 1 else 1)
-			self.__outputInverse = inverter(self.__outputInverse)
+		ans = self.__menger(divisions, self.__memmap(divisions, mmapFile))
+		# Invert the 1's and 0's in place.
+		np.logical_not(ans, out=ans)
 
 		if filename:
-			vox = vx.from_dense(self.__outputInverse)
-			vw(filename, vox).write()
+			_writeVox(filename, ans, self.__voxPalette())
 
-		return self.__outputInverse
+		return ans
 # ______________________________________________________
 # ______________________________________________________
 
@@ -263,7 +471,8 @@ if __name__ == "__main__":
 	op = menger.output(num, "menger_pattern.vox")
 
 	"""
-	for i in range(pow(3, num)):
-		slc = menger.sliced(depth=i, filename="menger_sliced_{}.vox".format(i+1))
+	depths = range(pow(3, num))
+	names = ["menger_sliced_{}.vox".format(i+1) for i in depths]
+	menger.slicedMany(depths, names)
 	"""
 